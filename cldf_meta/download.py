@@ -2,12 +2,30 @@
 
 import hashlib
 import os
+import random
 import time
 import sys
-from urllib import request
-from urllib.error import HTTPError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from urllib.parse import urlparse
 
+import urllib3
+
+# Maximum number of downloads running at the same time.
+MAX_WORKERS = 4
+# Number of bytes read at a time when streaming a download to disk.
+CHUNK_SIZE = 1024 * 1024
+
+# Shared connection pool, so that consecutive downloads from the same host
+# can reuse an open connection instead of doing a new TLS handshake each time.
+# Bad responses (429 in particular) are handled by `request_or_wait`, so
+# urllib3 itself only retries connection errors and follows redirects.
+POOL_MANAGER = urllib3.PoolManager(
+    maxsize=MAX_WORKERS,
+    retries=urllib3.Retry(
+        total=3, status=0, respect_retry_after_header=False))
+
 
 def retrieve_access_token():
     """Get access token from environment.
@@ -65,80 +83,148 @@ def wait_until(secs_since_epoch):
     time.sleep(dt)
 
 
-def download_or_wait(url):
-    """Download data from one url waiting for the ratelimit."""
+def wait_for_ratelimit(headers):
+    """Wait until Zenodo's rate limit is reset."""
+    limit_reset = int(headers['X-RateLimit-Reset'])
+    retry_after = int(headers['Retry-After'])
+    wait_until(max(limit_reset, time_secs() + retry_after))
+
+
+def request_or_wait(url, preload_content=True):
+    """Send a GET request to `url` waiting for the ratelimit.
+
+    Returns the response of the first successful attempt.  With
+    `preload_content=False` the body is left unread, so it can be streamed.
+    """
     retries = 3
     for attempt in range(retries):
         try:
-            with request.urlopen(url) as response:
-                return response.read()
-        except HTTPError as e:
-            if e.code == 429:
-                # too many requests
-                limit_reset = int(e.headers['X-RateLimit-Reset'])
-                retry_after = int(e.headers['Retry-After'])
-                wait_until(max(limit_reset, time_secs() + retry_after))
-            else:
-                print(
-                    f'Unexpected http response: {e.code}',
-                    e.read().decode('utf-8').strip(),
-                    f'Attempt {attempt + 1} of {retries}; retrying...',
-                    sep='\n', file=sys.stderr, flush=True)
+            response = POOL_MANAGER.request(
+                'GET', url, preload_content=preload_content)
+        except urllib3.exceptions.HTTPError as err:
+            # keep raising OSErrors like urlopen did (and don't leak the
+            # access token in the query string)
+            raise IOError(
+                f'Could not connect to {urlparse(url).netloc}') from err
+        if response.status == 429:
+            # too many requests
+            response.drain_conn()
+            wait_for_ratelimit(response.headers)
+        elif response.status >= 400:
+            print(
+                f'Unexpected http response: {response.status}',
+                response.data.decode('utf-8').strip(),
+                f'Attempt {attempt + 1} of {retries}; retrying...',
+                sep='\n', file=sys.stderr, flush=True)
+            if attempt + 1 < retries:
+                # jitter, so parallel workers don't retry in lock-step
+                time.sleep(min(60, 2 ** attempt) + random.uniform(0, 1))
+        else:
+            return response
     else:
         raise IOError(f'Tried {retries} times to no avail.  Giving up...')
 
 
+def ratelimited_map(func, args, max_workers=MAX_WORKERS):
+    """Call `func` on each element of `args` at a ratelimit-friendly pace.
+
+    `func` has to return a tuple `(result, response_headers)`.
+
+    Keeps up to `max_workers` calls in flight, but never more than the
+    rate limit reported by the latest response allows.  Yields the results
+    in the same order as `args`.
+    """
+    in_flight = deque()
+    limit_remaining = max_workers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for arg in args:
+            while len(in_flight) >= min(max_workers, limit_remaining):
+                result, headers = in_flight.popleft().result()
+                yield result
+                limit_remaining = int(headers['X-RateLimit-Remaining'])
+                if limit_remaining == 0:
+                    # finish what is already running, then pause
+                    while in_flight:
+                        yield in_flight.popleft().result()[0]
+                    wait_for_ratelimit(headers)
+                    limit_remaining = max_workers
+            in_flight.append(executor.submit(func, arg))
+        while in_flight:
+            yield in_flight.popleft().result()[0]
+
+
+def _download_data(url):
+    response = request_or_wait(url)
+    return response.data, response.headers
+
+
 def download_all(urls):
     """Download data from multiple urls at a ratelimit-friendly pace."""
-    retries = 3
-    for url in urls:
-        for attempt in range(retries):
-            try:
-                with request.urlopen(url) as response:
-                    yield response.read()
-                    limit_remaining = int(response.headers['X-RateLimit-Remaining'])
-                    if limit_remaining == 0:
-                        limit_reset = int(response.headers['X-RateLimit-Reset'])
-                        retry_after = int(response.headers['Retry-After'])
-                        wait_until(max(limit_reset, time_secs() + retry_after))
-                    # no retries needed
-                    break
-            except HTTPError as e:
-                if e.code == 429:
-                    # too many requests
-                    limit_reset = int(e.headers['X-RateLimit-Reset'])
-                    retry_after = int(e.headers['Retry-After'])
-                    wait_until(max(limit_reset, time_secs() + retry_after))
-                else:
-                    print(
-                        f'Unexpected http response: {e.code}',
-                        e.read().decode('utf-8').strip(),
-                        f'Attempt {attempt + 1} of {retries}; retrying...',
-                        sep='\n', file=sys.stderr, flush=True)
-        else:
-            raise IOError(f'Tried {retries} times to no avail.  Giving up...')
+    return ratelimited_map(_download_data, urls)
+
 
+def download_to(url, path, checksum=None):
+    """Stream the data from `url` into the file at `path`.
 
-def validate_checksum(checksum, data):
-    """Validate `data` by comparing its hash to `checksum`.
+    If given, `checksum` is validated while the data is written.  It is
+    assumed to look like `hashing_algorithm:hex_checksum` (e.g.
+    `md5:6f5902ac237024bdd0c176cb93063dc4`).  The file only appears at `path`
+    once the download is complete and valid.
 
-    `checksum` is assumed to look like `hashing_algorithm:hex_checksum`
-    (e.g. `md5:6f5902ac237024bdd0c176cb93063dc4`).
+    Returns the headers of the response.
     """
-    fields = checksum.split(':', maxsplit=1)
-    if len(fields) != 2:
-        raise ValueError('Could not determine hashing algorithm')
+    if checksum:
+        fields = checksum.split(':', maxsplit=1)
+        if len(fields) != 2:
+            raise ValueError('Could not determine hashing algorithm')
+        algo, expected_sum = fields
+        h = hash_constructor(algo)()
+    else:
+        h = None
+    path.parent.mkdir(parents=True, exist_ok=True)
+    part_path = path.with_name(f'{path.name}.part')
+    response = request_or_wait(url, preload_content=False)
+    try:
+        with open(part_path, 'wb') as f:
+            for chunk in response.stream(CHUNK_SIZE):
+                f.write(chunk)
+                if h is not None:
+                    h.update(chunk)
+        if h is not None and (real_sum := h.hexdigest()) != expected_sum:
+            raise ValueError(
+                'Checksum validation failed: '
+                "Expected %s sum '%s'; got '%s'."
+                % (algo, expected_sum, real_sum))
+    except BaseException as err:
+        part_path.unlink(missing_ok=True)
+        if isinstance(err, urllib3.exceptions.HTTPError):
+            raise IOError(f'Download interrupted: {path.name}') from err
+        raise
+    finally:
+        response.release_conn()
+    part_path.replace(path)
+    return response.headers
+
+
+def _download_file(download):
+    url, path, checksum = download
+    return path, download_to(url, path, checksum)
+
+
+def download_all_to(downloads):
+    """Download multiple files at a ratelimit-friendly pace.
+
+    `downloads` is an iterable of `(url, path, checksum)` tuples (see
+    `download_to`).  Yields the paths of the finished files.
+    """
+    return ratelimited_map(_download_file, downloads)
+
 
-    algo, expected_sum = fields
+@lru_cache(maxsize=None)
+def hash_constructor(algo):
+    """Return the hashlib constructor for hashing algorithm `algo`."""
     if algo not in hashlib.algorithms_available:
         raise ValueError(
             "Hashing algorithm '%s' not available in hashlib" % algo)
-
-    h = hashlib.new(algo)
-    h.update(data)
-    real_sum = h.hexdigest()
-
-    if real_sum != expected_sum:
-        raise ValueError(
-            'Checksum validation failed: '
-            "Expected %s sum '%s'; got '%s'." % (algo, expected_sum, real_sum))
+    # the named constructors (`hashlib.md5` etc.) skip `hashlib.new`'s lookup
+    return getattr(hashlib, algo, None) or partial(hashlib.new, algo)
@@ -1,6 +1,5 @@
 """Utility functions for cldf_meta."""
 
-import re
 import sys
 
 
@@ -18,14 +17,3 @@ def loggable_progress(things, file=sys.stderr):
         yield thing
     print('done.', file=file, flush=True)
 
-
-def path_contains(path, regex):
-    """Return `True` iff an element in `path` matches `regex`."""
-    while True:
-        parent, name = path.parent, path.name
-        if re.fullmatch(regex, name):
-            return True
-        elif parent == path:
-            return False
-        else:
-            path = parent
@@ -4,13 +4,18 @@ import contextlib
 import csv
 import io
 import json
+import posixpath
 import zipfile
 from collections import ChainMap
+from functools import lru_cache
 from itertools import islice
 from pathlib import Path
 
 from pycldf.terms import URL as TERMS_URL
 
+# Read (and decompress) tables in bigger chunks than io's default 8 KiB.
+READ_BUFFER_SIZE = 1024 * 1024
+
 
 def get_cldf_json(f):
     try:
@@ -19,7 +24,8 @@ def get_cldf_json(f):
         if not f.read(10).lstrip().startswith(bytes([123])):
             return None
         f.seek(0)
-        json_data = json.load(f, encoding='utf-8')
+        # json.loads detects the encoding of raw bytes by itself
+        json_data = json.loads(f.read())
         if not json_data.get('dc:conformsTo', '').startswith(TERMS_URL):
             return None
         return json_data
@@ -59,8 +65,14 @@ def skip_columns(rows, skip_count):
         return rows
 
 
+@lru_cache(maxsize=None)
+def term_urls(column_names):
+    # The same few column tuples are requested for every single dataset.
+    return {f'{TERMS_URL}#{col}': col for col in column_names}
+
+
 def rename_columns(column_specs, column_names, raw_rows):
-    col_urls = {f'{TERMS_URL}#{col}': col for col in column_names}
+    col_urls = term_urls(tuple(column_names))
     name_map = {
         col['name']: col_urls[purl]
         for col in column_specs
@@ -70,11 +82,18 @@ def rename_columns(column_specs, column_names, raw_rows):
     header = [
         name_map.get(orig_name, orig_name)
         for orig_name in next(row_i, ())]
+    # pick out the wanted columns once instead of filtering every cell
+    column_names = frozenset(column_names)
+    wanted = [
+        (index, colname)
+        for index, colname in enumerate(header)
+        if colname and colname in column_names]
     for row in row_i:
+        row_length = len(row)
         yield {
-            colname: cell
-            for colname, cell in zip(header, row)
-            if colname and cell and colname in column_names}
+            colname: row[index]
+            for index, colname in wanted
+            if index < row_length and row[index]}
 
 
 class ZipDataReader:
@@ -83,17 +102,46 @@ class ZipDataReader:
         self._zip_infos = zip_infos
         self._md_root = md_root
         self._cldf_md = cldf_md
+        # tables by their `dc:conformsTo` url (the first one wins)
+        self._tables = {}
+        for table in cldf_md.get('tables', ()):
+            self._tables.setdefault(table.get('dc:conformsTo', ''), table)
+        # zipped tables that live in a zip file of their own
+        self._inner_zips = {}
+        self._exit_stack = contextlib.ExitStack()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._exit_stack.close()
+        self._inner_zips.clear()
+
+    def _open_inner_zip(self, zip_info):
+        # Open each inner zip file only once and index its members by name,
+        # so that reading several tables doesn't re-read its directory.
+        if (inner := self._inner_zips.get(zip_info.filename)) is None:
+            outer_f = self._exit_stack.enter_context(
+                self._zip_file.open(zip_info))
+            internal_zip = self._exit_stack.enter_context(
+                zipfile.ZipFile(outer_f))
+            index = {}
+            for info in internal_zip.infolist():
+                index.setdefault(Path(info.filename).name, info)
+            inner = self._inner_zips[zip_info.filename] = internal_zip, index
+        return inner
 
     def cldf_module(self):
         return self._cldf_md['dc:conformsTo'].split('#')[-1]
 
     def get_table(self, name_or_url):
-        url = f'{TERMS_URL}#{name_or_url}'
-        for table in self._cldf_md['tables']:
-            if table.get('dc:conformsTo', '') == url:
-                return table
-        else:
-            raise ValueError(f'table not found: {name_or_url}')
+        try:
+            return self._tables[f'{TERMS_URL}#{name_or_url}']
+        except KeyError:
+            raise ValueError(f'table not found: {name_or_url}') from None
 
     def iterrows(self, table, *column_names):
         try:
@@ -147,29 +195,29 @@ class ZipDataReader:
         else:
             escapechar = '\\'
 
-        relpath = table['url']
-        root = self._md_root
-        while relpath.startswith('../'):
-            relpath, root = relpath[3:], root.parent
-        relpath_zip = f'{relpath}.zip'
-
+        # zip files always use forward slashes
+        table_path = Path(posixpath.normpath(self._md_root / table['url']))
         zip_info = (
-            self._zip_infos.get(root / relpath_zip)
-            or self._zip_infos.get(root / relpath))
+            self._zip_infos.get(table_path.with_name(f'{table_path.name}.zip'))
+            or self._zip_infos.get(table_path))
         if zip_info is None:
             # TODO: maybe show an error message?
             return
 
-        with contextlib.ExitStack() as withs:
-            csv_f = withs.enter_context(self._zip_file.open(zip_info))
-            if zip_info.filename.endswith('.zip'):
-                internal_zip = withs.enter_context(zipfile.ZipFile(csv_f))
-                internal_info = next(
-                    info
-                    for info in internal_zip.infolist()
-                    if info.filename.endswith(Path(relpath).name))
-                csv_f = withs.enter_context(internal_zip.open(internal_info))
-            decoder = io.TextIOWrapper(csv_f, encoding=encoding)
+        if zip_info.filename.endswith('.zip'):
+            internal_zip, index = self._open_inner_zip(zip_info)
+            internal_info = index.get(table_path.name)
+            if internal_info is None:
+                return
+            zip_file, zip_info = internal_zip, internal_info
+        else:
+            zip_file = self._zip_file
+
+        with zip_file.open(zip_info) as csv_f:
+            buffered_f = io.BufferedReader(csv_f, buffer_size=READ_BUFFER_SIZE)
+            # csv.reader takes care of newlines inside of quoted cells itself
+            decoder = io.TextIOWrapper(
+                buffered_f, encoding=encoding, newline='')
             rdr = csv.reader(
                 decoder,
                 doublequote=dialect['doubleQuote'],
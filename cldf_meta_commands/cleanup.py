@@ -27,12 +27,18 @@ def cleanup(dataset, args):
     if answer.strip().lower() not in {'y', 'yes'}:
         return
 
+    by_folder = {}
     for file_path in not_cldf:
-        print('rm', file_path, file=sys.stderr)
-        file_path.unlink()
-        if next(file_path.parent.iterdir(), None) is None:
-            print('rmdir', file_path, file=sys.stderr)
-            file_path.parent.rmdir()
+        by_folder.setdefault(file_path.parent, []).append(file_path)
+
+    for folder, file_paths in by_folder.items():
+        for file_path in file_paths:
+            print('rm', file_path, file=sys.stderr)
+            file_path.unlink()
+        # only look at the folder once, after all its files are gone
+        if next(folder.iterdir(), None) is None:
+            print('rmdir', folder, file=sys.stderr)
+            folder.rmdir()
 
 
 def run(args):
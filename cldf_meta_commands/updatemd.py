@@ -4,11 +4,13 @@ Update Zenodo metadata in `raw/zenodo-metadata.json`.
 
 import csv
 import json
+import math
 import pprint
 import re
 import sys
 from itertools import chain, islice
-from urllib.parse import quote
+from operator import itemgetter
+from urllib.parse import quote, urlencode
 
 from cldfbench.cli_util import add_dataset_spec, with_dataset
 
@@ -79,7 +81,16 @@ TITLE_BLACKLIST_REGEX = r'''
     | ^paceofchange:
     | ^PoePy\.\ A\ Python\ library
     | ^PyBor:\ A\ Python\ library
+    | ^\S*?(?:glottolog|clts|concepticon)\S*?:
 '''
+TITLE_BLACKLIST_RE = re.compile(TITLE_BLACKLIST_REGEX, re.VERBOSE)
+
+# I've only seen github so far but I want to at least check for these
+GIT_HOSTS_RE = re.compile(
+    r'bitbucket\.org|codeberg\.org|gitlab\.|sr\.ht|github\.com')
+
+# Number of records per page of search results
+SEARCH_PAGE_SIZE = 100
 
 
 ZENODO_METADATA_SCHEMA = {
@@ -203,9 +214,7 @@ def build_search_url(params):
     """Build url for downloading record metadata from Zenodo."""
     entity = 'records'
     api = 'https://zenodo.org/api'
-    param_str = '&'.join(
-        '{}={}'.format(quote(k, safe=''), quote(v, safe=''))
-        for k, v in params)
+    param_str = urlencode(params, quote_via=quote)
     return '{api}/{entity}{param_prefix}{params}'.format(
         api=api, entity=entity,
         param_prefix='?' if param_str else '',
@@ -225,27 +234,68 @@ def build_doi_url(access_token, doi):
     return build_search_url(params_doi)
 
 
+def parse_search_results(raw_data):
+    json_data = json.loads(raw_data)
+    if not ZENODO_JSON_VALIDATOR.validate(json_data):
+        msg = pprint.pformat(ZENODO_JSON_VALIDATOR.errors)
+        raise ValueError(f"Zenodo's response has changed\n{msg}")
+    return json_data
+
+
+def search_page_url(url, page):
+    return f'{url}&size={SEARCH_PAGE_SIZE}&page={page}'
+
+
+def follow_up_page_urls(url, json_data):
+    """Return the urls of the pages after `json_data` in the search at `url`.
+
+    The page size is taken from the number of hits on the first page, in case
+    Zenodo hands out fewer hits per page than we asked for.
+    """
+    if not (hits := json_data['hits']['hits']):
+        return []
+    page_count = math.ceil(json_data['hits']['total'] / len(hits))
+    return [
+        search_page_url(url, page)
+        for page in range(2, page_count + 1)]
+
+
+def download_searches(urls):
+    """Yield the hits on each page of the searches at `urls`.
+
+    The first pages of all searches are downloaded before any of the
+    remaining pages, which then all go through a single `dl.download_all`, so
+    that all requests share the same ratelimited pool.
+    """
+    first_pages = list(dl.download_all(
+        search_page_url(url, 1) for url in urls))
+    page_urls = []
+    for url, raw_data in zip(urls, first_pages):
+        json_data = parse_search_results(raw_data)
+        yield json_data['hits']['hits']
+        page_urls.extend(follow_up_page_urls(url, json_data))
+    for raw_data in dl.download_all(page_urls):
+        yield parse_search_results(raw_data)['hits']['hits']
+
+
 def download_records_paginated(url):
-    chunk_size = 100
-    page = 1
-    record_total = None
-    record_count = 0
-    while record_total is None or record_count < record_total:
-        the_url = f'{url}&size={chunk_size}&page={page}'
-        raw_data = dl.download_or_wait(the_url)
-        json_data = json.loads(raw_data)
-        if not ZENODO_JSON_VALIDATOR.validate(json_data):
-            msg = pprint.pformat(ZENODO_JSON_VALIDATOR.errors)
-            raise ValueError(f"Zenodo's response has changed\n{msg}")
-        if record_total is None:
-            record_total = json_data['hits']['total']
-        hits = json_data['hits']['hits']
-        record_count += len(hits)
-        page += 1
-        yield hits
+    return download_searches([url])
+
+
+def drop_seen_hits(pages):
+    """Drop hits from `pages` that already showed up on an earlier page.
+
+    The keyword, community, and DOI searches overlap quite a bit.
+    """
+    seen = set()
+    for hits in pages:
+        new_hits = [hit for hit in hits if hit['id'] not in seen]
+        seen.update(hit['id'] for hit in new_hits)
+        yield new_hits
 
 
 def make_flat_record(record):
+    metadata = record['metadata']
     new_record = {
         'id': record['id'],
         'doi': record['doi'],
@@ -254,21 +304,21 @@ def make_flat_record(record):
         'created': record['created'],
         'updated': record['updated'],
         'modified': record['modified'],
-        'title': record['metadata']['title'],
-        'description': record['metadata']['description'],
-        'version': record['metadata']['version'],
-        'access_right': record['metadata']['access_right'],
-        'publication_date': record['metadata']['publication_date'],
-        'license': record['metadata']['license']['id'],
-        'creators': list(map(drop_nulls, record['metadata']['creators'])),
+        'title': metadata['title'],
+        'description': metadata['description'],
+        'version': metadata['version'],
+        'access_right': metadata['access_right'],
+        'publication_date': metadata['publication_date'],
+        'license': metadata['license']['id'],
+        'creators': list(map(drop_nulls, metadata['creators'])),
         'files': list(map(flatten_file, record['files'])),
     }
-    type_struct = record['metadata'].get('resource_type')
+    type_struct = metadata.get('resource_type')
     if type_struct and (type_ := type_struct.get('type')):
         new_record['resource_type'] = type_
-    if (keywords := record['metadata'].get('keywords')):
+    if (keywords := metadata.get('keywords')):
         new_record['keywords'] = keywords
-    if (contributors := record['metadata'].get('contributors')):
+    if (contributors := metadata.get('contributors')):
         new_record['contributors'] = list(map(drop_nulls, contributors))
     if (git_link := retrieve_git_link(record)):
         new_record['git-link'] = git_link
@@ -288,13 +338,10 @@ def drop_nulls(mapping):
 
 
 def retrieve_git_link(record):
-    # I've only seen github so far but I want to at least check for these
-    hosts = (
-        'bitbucket.org', 'codeberg.org', 'gitlab.', 'sr.ht', 'github.com')
     git_links = [
         relid['identifier']
         for relid in record['metadata'].get('related_identifiers', ())
-        if any(host in relid['identifier'] for host in hosts)]
+        if GIT_HOSTS_RE.search(relid['identifier'])]
     if len(git_links) < 1:
         return None
     elif len(git_links) == 1:
@@ -308,6 +355,9 @@ def retrieve_git_link(record):
 
 def register(parser):
     add_dataset_spec(parser)
+    parser.add_argument(
+        '--full', action='store_true', default=False,
+        help='Re-download all records, not just recently updated ones.')
 
 
 def might_have_cldf_in_it(record):
@@ -318,9 +368,9 @@ def might_have_cldf_in_it(record):
      3. Ignore everything made before 2018 (CLDF didn't exist, yet).
     """
     if (date := record.get('created')):
-        match = re.match(r'(\d\d\d\d)-(\d\d)-(\d\d)', date)
-        assert match, '`date` needs to be YYYY-MM-DD, not {repr(date)}'
-        if int(match.group(1)) < 2018:
+        assert len(date) >= 10 and date[4] == date[7] == '-', \
+            f'`date` needs to be YYYY-MM-DD, not {repr(date)}'
+        if int(date[:4]) < 2018:
             return False
 
     if (type_ := record.get('resource_type')):
@@ -328,13 +378,7 @@ def might_have_cldf_in_it(record):
             return False
 
     if (title := record.get('title')):
-        if re.search(TITLE_BLACKLIST_REGEX, title, re.VERBOSE):
-            return False
-        elif re.match(r'(?:\S*?)glottolog(?:\S*?):', title.strip()):
-            return False
-        elif re.match(r'(?:\S*?)clts(?:\S*?):', title.strip()):
-            return False
-        elif re.match(r'(?:\S*?)concepticon(?:\S*?):', title.strip()):
+        if TITLE_BLACKLIST_RE.match(title.strip()):
             return False
 
     return True
@@ -354,14 +398,23 @@ def updatemd(dataset, args):
     else:
         records = {}
 
+    # Only ask for records that changed since the last update (by date, so
+    # records from the same day are re-downloaded rather than missed).
+    if records and not args.full:
+        cutoff = max(record['updated'] for record in records.values())[:10]
+        updated_since = f' AND updated:[{cutoff} TO *]'
+    else:
+        updated_since = ''
+
     with open(dataset.etc_dir / 'whitelist.csv', encoding='utf-8') as f:
         rdr = csv.reader(f)
         whitelist = [doi for doi, _ in islice(rdr, 1, None) if doi]
 
     print('downloading records...', file=sys.stderr, flush=True)
 
-    query_kw = 'keywords:({})'.format(
-        ' OR '.join(f'"{kw}"' for kw in SEARCH_KEYWORDS))
+    query_kw = 'keywords:({}){}'.format(
+        ' OR '.join(f'"{kw}"' for kw in SEARCH_KEYWORDS),
+        updated_since)
     params_kw = [
         ('sort', 'mostrecent'),
         ('all_versions', 'true'),
@@ -372,8 +425,9 @@ def updatemd(dataset, args):
     if access_token:
         params_kw.append(('access_token', access_token))
 
-    query_comm = 'communities:({})'.format(
-        ' OR '.join(f'"{kw}"' for kw in SEARCH_COMMUNITIES))
+    query_comm = 'communities:({}){}'.format(
+        ' OR '.join(f'"{kw}"' for kw in SEARCH_COMMUNITIES),
+        updated_since)
     params_comm = [
         ('sort', 'mostrecent'),
         ('all_versions', 'true'),
@@ -389,19 +443,21 @@ def updatemd(dataset, args):
         build_doi_url(access_token, doi)
         for doi in whitelist]
 
-    def _download_individual_dois(doi_urls):
-        for hits in map(download_records_paginated, doi_urls):
-            yield from hits
-
     try:
-        records.update(loggable_progress(
-            (record['id'], record)
-            for hits in chain(
-                download_records_paginated(keyword_url),
-                download_records_paginated(community_url),
-                _download_individual_dois(doi_urls))
-            for hit in hits
-            if might_have_cldf_in_it((record := make_flat_record(hit)))))
+        pages = chain(
+            download_records_paginated(keyword_url),
+            download_records_paginated(community_url),
+            download_searches(doi_urls))
+        for hits in loggable_progress(drop_seen_hits(pages)):
+            for hit in hits:
+                # skip records we already have and which haven't changed
+                # (unless asked to rebuild everything)
+                old_record = None if args.full else records.get(hit['id'])
+                if old_record and old_record['updated'] == hit['updated']:
+                    continue
+                record = make_flat_record(hit)
+                if might_have_cldf_in_it(record):
+                    records[record['id']] = record
     except IOError as err:
         print(err, file=sys.stderr)
         sys.exit(74)
@@ -409,7 +465,7 @@ def updatemd(dataset, args):
     new_metadata = {
         'records': sorted(
             records.values(),
-            key=lambda r: r['updated'],
+            key=itemgetter('updated'),
             reverse=True),
     }
     with open(metadata_file, 'w', encoding='utf-8') as f:
@@ -1,8 +1,10 @@
 import csv
+import re
 import sys
 import zipfile
 from collections import Counter, namedtuple
-from itertools import chain, islice
+from heapq import merge
+from itertools import chain, groupby, islice
 from multiprocessing import Pool
 from pathlib import Path
 
@@ -10,12 +12,21 @@ from cldfbench import Dataset as BaseDataset
 from cldfbench.cldf import CLDFSpec
 
 from cldf_meta import download as dl, zipdata
-from cldf_meta.util import loggable_progress, path_contains
+from cldf_meta.util import loggable_progress
 
 CLDFError = namedtuple('CLDFError', 'record_no file reason')
 DataArchive = namedtuple('DataArchive', 'record_no file_id path')
 Download = namedtuple('Download', 'url destination checksum')
 
+# CLDF metadata files are conventionally called `<module>-metadata.json` or
+# `cldf-metadata.json`.  Checking the file name first saves us from
+# decompressing and parsing every other json file in an archive.
+CLDF_METADATA_RE = re.compile(r'metadata\.json$', re.IGNORECASE)
+# Test suites and raw upstream data in cldfbenches.
+IGNORED_FOLDERS_RE = re.compile(r'(?:^|/)(?:raw|tests?)(?:/|$)')
+# Metadata files are a few dozen kB at most -- anything bigger is data.
+MAX_METADATA_SIZE = 2 * 1024 * 1024
+
 
 def download_path(data_dir, record_no, file_path):
     output_folder = (data_dir / record_no).resolve()
@@ -26,14 +37,14 @@ def download_path(data_dir, record_no, file_path):
 
 
 def download_datasets(downloads, access_token=None):
-    urls = (download.url for download in downloads)
     if access_token:
-        urls = (dl.add_access_token(url, access_token) for url in urls)
-    dls = dl.download_all(loggable_progress(urls, file=sys.stderr))
-    for raw_data, download in zip(dls, downloads):
-        dl.validate_checksum(download.checksum, raw_data)
-        download.destination.parent.mkdir(parents=True, exist_ok=True)
-        download.destination.write_bytes(raw_data)
+        downloads = (
+            download._replace(
+                url=dl.add_access_token(download.url, access_token))
+            for download in downloads)
+    # count the files as they finish, not as they are sent off
+    return list(loggable_progress(
+        dl.download_all_to(downloads), file=sys.stderr))
 
 
 def is_blacklisted(blacklist, record):
@@ -78,12 +89,23 @@ def collect_dataset_stats(record_no, zipreader):
         if (lid := ex.get('languageReference')))
 
     lang_iter = chain(lang_values, lang_forms, lang_examples, lang_entries)
-    langtable = {
-        r['id']: r.get('glottocode') or r.get('iso639P3code') or r.get('id')
-        for r in zipreader.iterrows(
+    langs = dict.fromkeys(lang_iter)
+
+    # Only look up the languages that are actually referenced and stop
+    # reading the language table once all of them have been found.
+    needed = set(langs)
+    langtable = {}
+    if needed:
+        rows = zipreader.iterrows(
             'LanguageTable', 'id', 'glottocode', 'iso639P3code')
-        if r.get('id')}
-    langs = {v: (langtable.get(v) or v) for v in lang_iter}
+        for r in rows:
+            if (lid := r.get('id')) in needed:
+                langtable[lid] = (
+                    r.get('glottocode') or r.get('iso639P3code') or lid)
+                needed.discard(lid)
+                if not needed:
+                    break
+    langs = {v: (langtable.get(v) or v) for v in langs}
 
     # TODO count concepticon ids?
     parameter_count = sum(1 for _ in zipreader.iterrows('ParameterTable', 'id'))
@@ -111,10 +133,11 @@ def _stats_from_zip(data_archive):
     with zipfile.ZipFile(zip_path) as zip:
         file_tree = {Path(info.filename): info for info in zip.infolist()}
         for path, info in file_tree.items():
-            if path.suffix != '.json':
+            if not CLDF_METADATA_RE.search(info.filename):
                 continue
-            # Filter out test suites and raw upstream data in cldfbenches.
-            if path_contains(path, 'raw|tests?'):
+            if IGNORED_FOLDERS_RE.search(info.filename):
+                continue
+            if info.file_size > MAX_METADATA_SIZE:
                 continue
             with zip.open(info) as f:
                 cldf_md = zipdata.get_cldf_json(f)
@@ -123,7 +146,9 @@ def _stats_from_zip(data_archive):
             zipreader = zipdata.ZipDataReader(
                 zip, file_tree, path.parent, cldf_md)
             found_data = True
-            yield collect_dataset_stats(record_no, zipreader), None
+            with zipreader:
+                stats = collect_dataset_stats(record_no, zipreader)
+            yield stats, None
     if not found_data:
         yield None, CLDFError(record_no, file_id, 'nocldf')
 
@@ -147,10 +172,16 @@ def raw_stats_to_glottocode_stats(stats, by_glottocode, by_isocode):
         glottocode_to_lids[glottocode].append(lid)
 
     def accumulate_counts(count_map):
+        # only walk the languages that actually have counts -- most datasets
+        # leave most of these tables empty
+        counts = Counter()
+        for lid, count in count_map.items():
+            if (glottocode := lid_to_glottocode.get(lid)):
+                counts[glottocode] += count
         return {
             glottocode: sum_of_counts
-            for glottocode, lids in glottocode_to_lids.items()
-            if (sum_of_counts := sum(count_map.get(lid, 0) for lid in lids)) != 0}
+            for glottocode, sum_of_counts in counts.items()
+            if sum_of_counts != 0}
 
     return {
         'record_no': stats['record_no'],
@@ -162,7 +193,7 @@ def raw_stats_to_glottocode_stats(stats, by_glottocode, by_isocode):
         'entry_count': stats['entry_count'],
         'parameter_count': stats['parameter_count'],
         'example_count': stats['example_count'],
-        'langs': list(glottocode_to_lids),
+        'langs': sorted(glottocode_to_lids),
         'glottocode_values': accumulate_counts(stats['lang_values']),
         # 'glottocode_features': accumulate_counts(stats['lang_features']),
         'glottocode_forms': accumulate_counts(stats['lang_forms']),
@@ -184,10 +215,9 @@ class ErrorFilter:
 
 
 def languages_from_dataset_stats(dataset_stats, languoids_by_id):
-    all_glottocodes = sorted({
-        lid
-        for stats in dataset_stats
-        for lid in stats['langs']})
+    # `stats['langs']` is sorted for each dataset, so merging them is enough
+    sorted_langs = (stats['langs'] for stats in dataset_stats)
+    all_glottocodes = [lid for lid, _ in groupby(merge(*sorted_langs))]
 
     def macroarea(lg):
         m = lg.macroareas
@@ -206,18 +236,21 @@ def languages_from_dataset_stats(dataset_stats, languoids_by_id):
         for lid in all_glottocodes]
 
 
-def datasets_from_dataset_stats(dataset_stats):
+def dataset_ids(dataset_stats):
     datasets_per_contrib = Counter()
-
-    def dataset_id(record_no):
+    ids = []
+    for stats in dataset_stats:
+        record_no = stats['record_no']
         datasets_per_contrib[record_no] += 1
-        dataset_count = datasets_per_contrib[record_no]
-        return f'{record_no}-{dataset_count}'
+        ids.append(f'{record_no}-{datasets_per_contrib[record_no]}')
+    return ids
 
+
+def datasets_from_dataset_stats(dataset_stats):
     # XXX: how idempotent is this?
     return [
         {
-            'ID': dataset_id(stats['record_no']),
+            'ID': dataset_id,
             'Contribution_ID': stats['record_no'],
             'Module': stats['module'],
             'Language_Count': stats['lang_count'],
@@ -228,23 +261,31 @@ def datasets_from_dataset_stats(dataset_stats):
             'Entry_Count': stats['entry_count'],
             'Example_Count': stats['example_count'],
         }
-        for stats in dataset_stats]
+        for dataset_id, stats in zip(dataset_ids(dataset_stats), dataset_stats)]
 
 
 def dataset_languages_from_dataset_stats(dataset_stats, datasets):
-    return [
-        {
-            'ID': '{}-{}'.format(ds['ID'], lid),
-            'Language_ID': lid,
-            'Dataset_ID': ds['ID'],
-            # 'Parameter_Count': stats['glottocode_features'].get(lid, 0),
-            'Value_Count': stats['glottocode_values'].get(lid, 0),
-            'Form_Count': stats['glottocode_forms'].get(lid, 0),
-            'Entry_Count': stats['glottocode_entries'].get(lid, 0),
-            'Example_Count': stats['glottocode_examples'].get(lid, 0),
-        }
-        for ds, stats in zip(datasets, dataset_stats)
-        for lid in stats['langs']]
+    dataset_languages = []
+    for ds, stats in zip(datasets, dataset_stats):
+        dataset_id = ds['ID']
+        # feature_counts = stats['glottocode_features']
+        value_counts = stats['glottocode_values']
+        form_counts = stats['glottocode_forms']
+        entry_counts = stats['glottocode_entries']
+        example_counts = stats['glottocode_examples']
+        dataset_languages.extend(
+            {
+                'ID': f'{dataset_id}-{lid}',
+                'Language_ID': lid,
+                'Dataset_ID': dataset_id,
+                # 'Parameter_Count': feature_counts.get(lid, 0),
+                'Value_Count': value_counts.get(lid, 0),
+                'Form_Count': form_counts.get(lid, 0),
+                'Entry_Count': entry_counts.get(lid, 0),
+                'Example_Count': example_counts.get(lid, 0),
+            }
+            for lid in stats['langs'])
+    return dataset_languages
 
 
 def contributions_from_records(records, datasets):
@@ -306,10 +347,10 @@ class Dataset(BaseDataset):
                 '  to download the metadata.')
             return
 
-        files_without_cldf = {
+        files_without_cldf = frozenset(
             (record_no, file)
             for record_no, file, _ in islice(
-                self.etc_dir.read_csv('not-cldf.csv'), 1, None)}
+                self.etc_dir.read_csv('not-cldf.csv'), 1, None))
 
         # TODO: add 'All Versions' DOI for the meta database itself, once we have one.
         with open(self.etc_dir / 'blacklist.csv', encoding='utf-8') as f:
@@ -318,25 +359,25 @@ class Dataset(BaseDataset):
 
         data_dir = self.raw_dir / 'datasets'
 
-        records = (
-            record
-            for record in records
-            if not is_blacklisted(blacklist, record))
-        downloads = (
-            Download(
-                url=file['url'],
-                destination=download_path(
-                    data_dir, str(rec['id']), file['file_path']),
-                checksum=file['checksum'])
-            for rec in records
-            for file in rec.get('files', ())
-            # XXX what if someone sends a tarball?
-            if might_be_zip(file)
-            and (str(rec['id']), file['file_path']) not in files_without_cldf)
-        downloads = [
-            download
-            for download in downloads
-            if not download.destination.exists()]
+        downloads = []
+        for rec in records:
+            if is_blacklisted(blacklist, rec):
+                continue
+            record_no = str(rec['id'])
+            for file in rec.get('files', ()):
+                # XXX what if someone sends a tarball?
+                if not might_be_zip(file):
+                    continue
+                if (record_no, file['file_path']) in files_without_cldf:
+                    continue
+                destination = download_path(
+                    data_dir, record_no, file['file_path'])
+                if destination.exists():
+                    continue
+                downloads.append(Download(
+                    url=file['url'],
+                    destination=destination,
+                    checksum=file['checksum']))
 
         if downloads:
             print(
@@ -1,19 +1,40 @@
+import hashlib
+import http.server
+import io
+import json
+import socket
+import tempfile
+import threading
+import time
+import types
 import unittest
+import zipfile
 from pathlib import Path
+from unittest import mock
+from urllib.parse import parse_qs, unquote, urlparse
 
-from cldf_meta.util import path_contains
-from cldf_meta.zipdata import rename_columns
+from cldf_meta import download as dl
+from cldf_meta.zipdata import ZipDataReader, get_cldf_json, rename_columns
+from cldf_meta_commands import updatemd
+from cldf_meta_commands.updatemd import (
+    download_records_paginated, might_have_cldf_in_it)
 
 
 def test_valid(cldf_dataset, cldf_logger):
     assert cldf_dataset.validate(log=cldf_logger)
 
 
-def test_pathcontains():
-    path1 = Path('/usr/share/icons/Adwaita/index.theme')
-    assert not path_contains(path1, 'local')
-    assert path_contains(path1, 'share')
-    assert path_contains(path1, 'icons?')
+def test_might_have_cldf_in_it():
+    assert might_have_cldf_in_it({
+        'created': '2023-01-01T00:00:00',
+        'resource_type': 'dataset',
+        'title': 'lexibank/abvd: Austronesian Basic Vocabulary Database'})
+    assert not might_have_cldf_in_it({'created': '2017-12-31T00:00:00'})
+    assert not might_have_cldf_in_it({'resource_type': 'poster'})
+    assert not might_have_cldf_in_it({'title': 'LingPy: A Python library'})
+    assert not might_have_cldf_in_it({
+        'title': ' glottolog/glottolog-cldf: Glottolog as CLDF'})
+    assert not might_have_cldf_in_it({'title': 'cldf-clts/clts: CLTS 2.2'})
 
 
 class NormaliseColumnNames(unittest.TestCase):
@@ -52,3 +73,319 @@ class NormaliseColumnNames(unittest.TestCase):
         self.assertEqual(
             list(rename_columns(self.colspecs, cols, self.rows)),
             expected)
+
+    def test_short_and_empty_cells(self):
+        cols = ['my_custom_col', 'id', 'languageReference']
+        rows = self.rows[:1] + [['a', '', 'c'], ['d']]
+        expected = [
+            {'id': 'a', 'my_custom_col': 'c'},
+            {'id': 'd'}]
+        self.assertEqual(
+            list(rename_columns(self.colspecs, cols, rows)),
+            expected)
+
+
+class ReadZippedTables(unittest.TestCase):
+
+    def setUp(self):
+        terms = 'http://cldf.clld.org/v1.0/terms.rdf'
+        self.cldf_md = {
+            'dc:conformsTo': f'{terms}#StructureDataset',
+            'tables': [
+                {
+                    'url': 'values.csv',
+                    'dc:conformsTo': f'{terms}#ValueTable',
+                    'tableSchema': {'columns': [
+                        {'name': 'ID', 'propertyUrl': f'{terms}#id'},
+                        {
+                            'name': 'Language_ID',
+                            'propertyUrl': f'{terms}#languageReference',
+                        },
+                    ]},
+                },
+                {
+                    'url': 'languages.csv',
+                    'dc:conformsTo': f'{terms}#LanguageTable',
+                    'tableSchema': {'columns': [
+                        {'name': 'ID', 'propertyUrl': f'{terms}#id'},
+                        {
+                            'name': 'Glottocode',
+                            'propertyUrl': f'{terms}#glottocode',
+                        },
+                    ]},
+                },
+            ],
+        }
+
+        inner_zip = io.BytesIO()
+        with zipfile.ZipFile(inner_zip, 'w') as z:
+            z.writestr('values.csv', 'ID,Language_ID\n1,lang1\n2,lang2\n')
+        self.zip_data = io.BytesIO()
+        with zipfile.ZipFile(self.zip_data, 'w') as z:
+            z.writestr('ds/cldf/cldf-metadata.json', json.dumps(self.cldf_md))
+            z.writestr('ds/cldf/values.csv.zip', inner_zip.getvalue())
+            z.writestr(
+                'ds/cldf/languages.csv',
+                'ID,Glottocode\nlang1,abcd1234\nlang2,\n')
+
+    def test_get_cldf_json(self):
+        with zipfile.ZipFile(self.zip_data) as z:
+            with z.open('ds/cldf/cldf-metadata.json') as f:
+                self.assertEqual(get_cldf_json(f), self.cldf_md)
+        self.assertIsNone(get_cldf_json(io.BytesIO(b'{"tables": []}')))
+        self.assertIsNone(get_cldf_json(io.BytesIO(b'[1, 2, 3]')))
+
+    def test_iterrows(self):
+        with zipfile.ZipFile(self.zip_data) as z:
+            file_tree = {Path(info.filename): info for info in z.infolist()}
+            reader = ZipDataReader(
+                z, file_tree, Path('ds/cldf'), self.cldf_md)
+            with reader:
+                self.assertEqual(reader.cldf_module(), 'StructureDataset')
+                self.assertEqual(
+                    list(reader.iterrows('ValueTable', 'languageReference')),
+                    [{'languageReference': 'lang1'},
+                     {'languageReference': 'lang2'}])
+                self.assertEqual(
+                    list(reader.iterrows('LanguageTable', 'id', 'glottocode')),
+                    [{'id': 'lang1', 'glottocode': 'abcd1234'},
+                     {'id': 'lang2'}])
+                self.assertEqual(list(reader.iterrows('FormTable', 'id')), [])
+
+
+class LocalZenodo(http.server.BaseHTTPRequestHandler):
+    """Serves the request path as data, except for `/limit`, which is 429."""
+
+    def do_GET(self):
+        self.server.requested_paths.append(self.path)
+        if self.path.startswith('/limit'):
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('X-RateLimit-Reset', str(int(time.time())))
+            body = b''
+        else:
+            self.send_response(200)
+            self.send_header('X-RateLimit-Remaining', '10')
+            body = self.path.encode('utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadFromLocalServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), LocalZenodo)
+        self.server.requested_paths = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_one_request_per_attempt_on_429(self):
+        with mock.patch.object(dl, 'wait_for_ratelimit') as wait:
+            with self.assertRaises(IOError):
+                dl.request_or_wait(f'{self.url}/limit')
+        self.assertEqual(wait.call_count, 3)
+        self.assertEqual(self.server.requested_paths, ['/limit'] * 3)
+
+    def test_connection_errors_are_ioerrors(self):
+        # nothing listens on the port of a socket that was closed again
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        with self.assertRaises(IOError):
+            dl.request_or_wait(f'http://127.0.0.1:{port}/data')
+
+    def test_download_all_keeps_order(self):
+        paths = [f'/data/{i}' for i in range(10)]
+        data = list(dl.download_all(f'{self.url}{p}' for p in paths))
+        self.assertEqual(data, [p.encode('utf-8') for p in paths])
+
+    def test_download_to(self):
+        md5 = hashlib.md5(b'/file').hexdigest()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / 'sub' / 'file.zip'
+            dl.download_to(f'{self.url}/file', path, f'md5:{md5}')
+            self.assertEqual(path.read_bytes(), b'/file')
+
+            other_path = Path(tmp_dir) / 'other.zip'
+            with self.assertRaises(ValueError):
+                dl.download_to(f'{self.url}/file', other_path, 'md5:abc')
+            self.assertEqual(
+                sorted(p.name for p in Path(tmp_dir).iterdir()), ['sub'])
+
+
+def zenodo_hit(record_id, updated='2024-01-01T00:00:00'):
+    return {
+        'id': record_id,
+        'doi': f'10.5281/zenodo.{record_id}',
+        'conceptrecid': '1',
+        'conceptdoi': '10.5281/zenodo.1',
+        'created': '2023-01-01T00:00:00',
+        'updated': updated,
+        'modified': updated,
+        'metadata': {
+            'title': f'Dataset {record_id}',
+            'description': 'A CLDF dataset',
+            'version': 'v1.0',
+            'access_right': 'open',
+            'publication_date': '2023-01-01',
+            'relations': {'version': [{
+                'index': 0,
+                'is_last': True,
+                'parent': {'pid_type': 'recid', 'pid_value': '1'},
+            }]},
+            'license': {'id': 'cc-by-4.0'},
+            'creators': [{'affiliation': None, 'name': 'Doe, Jane'}],
+        },
+        'files': [{
+            'key': 'dataset.zip',
+            'checksum': 'md5:6f5902ac237024bdd0c176cb93063dc4',
+            'links': {'self': f'https://zenodo.org/{record_id}/dataset.zip'},
+        }],
+    }
+
+
+class FakeZenodoSearch:
+    """Stands in for `dl.download_all`.
+
+    Serves `hits` in pages of at most `max_size` hits and remembers all
+    requested urls.
+    """
+
+    def __init__(self, hits, max_size=100):
+        self.hits = hits
+        self.max_size = max_size
+        self.urls = []
+
+    def download(self, url):
+        self.urls.append(url)
+        params = parse_qs(urlparse(url).query)
+        size = min(int(params['size'][0]), self.max_size)
+        page = int(params['page'][0])
+        json_data = {'hits': {
+            'hits': self.hits[(page - 1) * size:page * size],
+            'total': len(self.hits),
+        }}
+        return json.dumps(json_data).encode('utf-8')
+
+    def download_all(self, urls):
+        return map(self.download, list(urls))
+
+    def patch(self):
+        return mock.patch.object(dl, 'download_all', self.download_all)
+
+
+class PaginatedSearch(unittest.TestCase):
+
+    def test_all_pages(self):
+        zenodo = FakeZenodoSearch([zenodo_hit(i) for i in range(250)])
+        with zenodo.patch():
+            pages = list(download_records_paginated('https://z/api?q=x'))
+        self.assertEqual([len(hits) for hits in pages], [100, 100, 50])
+        self.assertEqual(
+            [hit['id'] for hits in pages for hit in hits], list(range(250)))
+
+    def test_short_pages(self):
+        zenodo = FakeZenodoSearch(
+            [zenodo_hit(i) for i in range(120)], max_size=25)
+        with zenodo.patch():
+            pages = list(download_records_paginated('https://z/api?q=x'))
+        self.assertEqual(
+            [hit['id'] for hits in pages for hit in hits], list(range(120)))
+
+    def test_first_pages_before_follow_up_pages(self):
+        zenodo = FakeZenodoSearch([zenodo_hit(i) for i in range(150)])
+        download_all_calls = []
+
+        def download_all(urls):
+            urls = list(urls)
+            # number of requests served so far, and the new ones
+            download_all_calls.append((len(zenodo.urls), len(urls)))
+            return FakeZenodoSearch.download_all(zenodo, urls)
+
+        zenodo.download_all = download_all
+        urls = ['https://z/api?q=a', 'https://z/api?q=b', 'https://z/api?q=c']
+        with zenodo.patch():
+            pages = list(updatemd.download_searches(urls))
+        self.assertEqual([len(hits) for hits in pages], [100] * 3 + [50] * 3)
+        self.assertEqual(download_all_calls, [(0, 3), (3, 3)])
+
+    def test_no_hits(self):
+        zenodo = FakeZenodoSearch([])
+        with zenodo.patch():
+            pages = list(download_records_paginated('https://z/api?q=x'))
+        self.assertEqual(pages, [[]])
+        self.assertEqual(len(zenodo.urls), 1)
+
+
+class UpdateMetadata(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        tmp_path = Path(self.tmp_dir.name)
+        self.dataset = types.SimpleNamespace(
+            raw_dir=tmp_path / 'raw', etc_dir=tmp_path / 'etc')
+        self.dataset.raw_dir.mkdir()
+        self.dataset.etc_dir.mkdir()
+        with open(self.dataset.etc_dir / 'whitelist.csv', 'w') as f:
+            f.write('DOI,Comment\n10.5281/zenodo.3,whitelisted\n')
+        self.metadata_file = self.dataset.raw_dir / 'zenodo-metadata.json'
+
+        old_record = updatemd.make_flat_record(
+            zenodo_hit(1, '2024-03-01T10:00:00'))
+        old_record['title'] = 'Stored title'
+        with open(self.metadata_file, 'w', encoding='utf-8') as f:
+            json.dump({'records': [old_record]}, f)
+
+        self.zenodo = FakeZenodoSearch([
+            zenodo_hit(1, '2024-03-01T10:00:00'),
+            zenodo_hit(2, '2024-03-02T10:00:00'),
+            zenodo_hit(3, '2024-03-02T12:00:00'),
+        ])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_updatemd(self, full):
+        make_flat_record = mock.Mock(wraps=updatemd.make_flat_record)
+        no_token = mock.patch.object(
+            dl, 'retrieve_access_token', return_value='')
+        counted = mock.patch.object(
+            updatemd, 'make_flat_record', make_flat_record)
+        with self.zenodo.patch(), no_token, counted:
+            updatemd.updatemd(self.dataset, types.SimpleNamespace(full=full))
+        with open(self.metadata_file, encoding='utf-8') as f:
+            records = json.load(f)['records']
+        queries = [
+            unquote(parse_qs(urlparse(url).query)['q'][0])
+            for url in self.zenodo.urls]
+        return records, queries, make_flat_record.call_count
+
+    def test_incremental_update(self):
+        records, queries, flattened = self.run_updatemd(full=False)
+        searches = [q for q in queries if not q.startswith('doi:')]
+        self.assertEqual(len(searches), 2)
+        for query in searches:
+            self.assertTrue(query.endswith(' AND updated:[2024-03-01 TO *]'))
+        doi_queries = [q for q in queries if q.startswith('doi:')]
+        self.assertEqual(len(doi_queries), 1)
+        self.assertNotIn('updated:', doi_queries[0])
+
+        self.assertEqual([r['id'] for r in records], [3, 2, 1])
+        self.assertEqual(records[2]['title'], 'Stored title')
+        self.assertEqual(flattened, 2)
+
+    def test_full_update(self):
+        records, queries, flattened = self.run_updatemd(full=True)
+        self.assertFalse(any('updated:' in query for query in queries))
+        self.assertEqual([r['id'] for r in records], [3, 2, 1])
+        self.assertEqual(records[2]['title'], 'Dataset 1')
+        self.assertEqual(flattened, 3)